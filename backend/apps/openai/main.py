@@ -1,12 +1,20 @@
 from fastapi import FastAPI, Request, Response, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from fastapi.responses import (
+    StreamingResponse,
+    JSONResponse,
+    FileResponse,
+    ORJSONResponse,
+)
 
-import requests
 import aiohttp
+import aiofiles
+import httpx
 import asyncio
-import json
+import orjson
 import logging
+import time
+import uuid
 
 from pydantic import BaseModel
 
@@ -37,7 +45,10 @@ from pathlib import Path
 log = logging.getLogger(__name__)
 log.setLevel(SRC_LOG_LEVELS["OPENAI"])
 
-app = FastAPI()
+SPEECH_CACHE_DIR = Path(CACHE_DIR).joinpath("./audio/speech/")
+SPEECH_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -53,17 +64,70 @@ app.state.OPENAI_API_BASE_URLS = OPENAI_API_BASE_URLS
 app.state.OPENAI_API_KEYS = OPENAI_API_KEYS
 
 app.state.MODELS = {}
+app.state.ASSISTANTS = {}
+
+# Merged upstream model/assistant lists are reused for MODELS_CACHE_TTL seconds,
+# and concurrent callers share a single in-flight fetch. A list missing an
+# unreachable upstream is only kept for MODELS_CACHE_FAILURE_TTL seconds so it
+# is retried soon, e.g. when the upstream isn't up yet at boot.
+MODELS_CACHE_TTL = 60
+MODELS_CACHE_FAILURE_TTL = 5
+
+app.state.MODELS_CACHE = {"ts": 0, "ttl": 0, "data": None, "future": None}
+app.state.ASSISTANTS_CACHE = {"ts": 0, "ttl": 0, "data": None, "future": None}
+
+app.state.aiohttp_session = None
+app.state.httpx_client = None
+
+
+async def start_aiohttp_session():
+    if app.state.aiohttp_session is None:
+        app.state.aiohttp_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=32,
+                ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+        )
+    return app.state.aiohttp_session
 
 
-@app.middleware("http")
-async def check_url(request: Request, call_next):
-    if len(app.state.MODELS) == 0:
-        await get_all_models()
-    else:
-        pass
+async def close_aiohttp_session():
+    if app.state.aiohttp_session is not None:
+        await app.state.aiohttp_session.close()
+        app.state.aiohttp_session = None
+
+
+# The models/assistants fan-out goes to the same hosts, so it uses an HTTP/2
+# client that multiplexes those requests over one connection per host
+async def start_httpx_client():
+    if app.state.httpx_client is None:
+        app.state.httpx_client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(60.0),
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        )
+    return app.state.httpx_client
+
+
+async def close_httpx_client():
+    if app.state.httpx_client is not None:
+        await app.state.httpx_client.aclose()
+        app.state.httpx_client = None
+
 
-    response = await call_next(request)
-    return response
+@app.on_event("startup")
+async def startup_event():
+    await start_aiohttp_session()
+    await start_httpx_client()
+    asyncio.create_task(warmup_models_and_assistants())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_aiohttp_session()
+    await close_httpx_client()
 
 
 class UrlsUpdateForm(BaseModel):
@@ -81,8 +145,9 @@ async def get_openai_urls(user=Depends(get_admin_user)):
 
 @app.post("/urls/update")
 async def update_openai_urls(form_data: UrlsUpdateForm, user=Depends(get_admin_user)):
-    await get_all_models()
     app.state.OPENAI_API_BASE_URLS = form_data.urls
+    invalidate_caches()
+    await get_all_models()
     return {"OPENAI_API_BASE_URLS": app.state.OPENAI_API_BASE_URLS}
 
 
@@ -94,6 +159,7 @@ async def get_openai_keys(user=Depends(get_admin_user)):
 @app.post("/keys/update")
 async def update_openai_key(form_data: KeysUpdateForm, user=Depends(get_admin_user)):
     app.state.OPENAI_API_KEYS = form_data.keys
+    invalidate_caches()
     return {"OPENAI_API_KEYS": app.state.OPENAI_API_KEYS}
 
 
@@ -103,10 +169,8 @@ async def speech(request: Request, user=Depends(get_verified_user)):
     try:
         idx = app.state.OPENAI_API_BASE_URLS.index("https://api.openai.com/v1")
         body = await request.body()
-        name = hashlib.sha256(body).hexdigest()
+        name = hashlib.blake2b(body, digest_size=16).hexdigest()
 
-        SPEECH_CACHE_DIR = Path(CACHE_DIR).joinpath("./audio/speech/")
-        SPEECH_CACHE_DIR.mkdir(parents=True, exist_ok=True)
         file_path = SPEECH_CACHE_DIR.joinpath(f"{name}.mp3")
         file_body_path = SPEECH_CACHE_DIR.joinpath(f"{name}.json")
 
@@ -120,22 +184,30 @@ async def speech(request: Request, user=Depends(get_verified_user)):
 
         r = None
         try:
-            r = requests.post(
+            session = await start_aiohttp_session()
+            r = await session.post(
                 url=f"{app.state.OPENAI_API_BASE_URLS[idx]}/audio/speech",
                 data=body,
                 headers=headers,
-                stream=True,
+                timeout=aiohttp.ClientTimeout(total=None),
             )
 
-            r.raise_for_status()
+            await check_response_status(r)
 
-            # Save the streaming content to a file
-            with open(file_path, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            # Save the streaming content to a per-request temp file, moving it into
+            # place only once complete so an interrupted or concurrent download is
+            # never served from the cache
+            part_path = SPEECH_CACHE_DIR.joinpath(f"{name}.{uuid.uuid4().hex}.part")
+            try:
+                async with aiofiles.open(part_path, "wb") as f:
+                    async for chunk in r.content.iter_chunked(65536):
+                        await f.write(chunk)
+                part_path.replace(file_path)
+            finally:
+                part_path.unlink(missing_ok=True)
 
-            with open(file_body_path, "w") as f:
-                json.dump(json.loads(body.decode("utf-8")), f)
+            async with aiofiles.open(file_body_path, "wb") as f:
+                await f.write(body)
 
             # Return the saved file
             return FileResponse(file_path)
@@ -145,44 +217,40 @@ async def speech(request: Request, user=Depends(get_verified_user)):
             error_detail = "Open WebUI: Server Connection Error"
             if r is not None:
                 try:
-                    res = r.json()
+                    res = await r.json(content_type=None)
                     if "error" in res:
                         error_detail = f"External: {res['error']}"
                 except:
                     error_detail = f"External: {e}"
 
             raise HTTPException(
-                status_code=r.status_code if r else 500, detail=error_detail
+                status_code=r.status if r else 500, detail=error_detail
             )
 
     except ValueError:
         raise HTTPException(status_code=401, detail=ERROR_MESSAGES.OPENAI_NOT_FOUND)
 
 
+async def check_response_status(r):
+    if not r.ok:
+        # Buffer the error body so it can still be reported after raising
+        await r.read()
+    r.raise_for_status()
+
+
 async def fetch_url(url, key):
-    if OPENAI_ASSISTANT_ID == "":
-        try:
-            headers = {"Authorization": f"Bearer {key}"}
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    return await response.json()
-        except Exception as e:
-            # Handle connection error here
-            log.error(f"Connection error: {e}")
-            return None
-    else:
-        try:
-            headers = {
-                "Authorization": f"Bearer {key}",
-                "OpenAI-Beta": "assistants=v2"
-                }
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    return await response.json()
-        except Exception as e:
-            # Handle connection error here
-            log.error(f"Connection error: {e}")
-            return None
+    headers = {"Authorization": f"Bearer {key}"}
+    if OPENAI_ASSISTANT_ID != "":
+        headers["OpenAI-Beta"] = "assistants=v2"
+
+    try:
+        client = await start_httpx_client()
+        response = await client.get(url, headers=headers)
+        return response.json()
+    except Exception as e:
+        # Handle connection error here
+        log.error(f"Connection error: {e}")
+        return None
 
 
 def merge_models_lists(model_lists):
@@ -191,12 +259,12 @@ def merge_models_lists(model_lists):
 
     for idx, models in enumerate(model_lists):
         if models is not None and "error" not in models:
+            is_openai = "api.openai.com" in app.state.OPENAI_API_BASE_URLS[idx]
             merged_list.extend(
                 [
                     {**model, "urlIdx": idx}
                     for model in models
-                    if "api.openai.com" not in app.state.OPENAI_API_BASE_URLS[idx]
-                    or "gpt" in model["id"]
+                    if not is_openai or "gpt" in model["id"]
                 ]
             )
 
@@ -219,9 +287,67 @@ def merge_assistants_lists(assistant_lists):
     return merged_list
 
 
-async def get_all_models():
-    log.info("get_all_models()")
+def invalidate_caches():
+    for cache in (app.state.MODELS_CACHE, app.state.ASSISTANTS_CACHE):
+        cache["ts"] = 0
+        cache["data"] = None
+        cache["future"] = None
+
 
+async def get_cached(cache, fetch, state_key, force=False):
+    if (
+        not force
+        and cache["data"] is not None
+        and time.time() - cache["ts"] < cache["ttl"]
+    ):
+        return cache["data"]
+
+    future = cache["future"]
+    if future is None:
+        future = asyncio.ensure_future(fetch_and_publish(cache, fetch, state_key))
+        cache["future"] = future
+
+    # Shield the fetch so a cancelled caller doesn't cancel it for the other waiters
+    return await asyncio.shield(future)
+
+
+async def fetch_and_publish(cache, fetch, state_key):
+    # Runs as the shared in-flight task, so the result is cached even if every
+    # caller that was waiting on it has gone away
+    task = asyncio.current_task()
+    try:
+        data, complete = await fetch()
+
+        # Don't cache or publish a result that was invalidated while it was
+        # in flight, so proxy never routes with a stale urlIdx map
+        if cache["future"] is task:
+            cache["data"] = data
+            cache["ts"] = time.time()
+            cache["ttl"] = MODELS_CACHE_TTL if complete else MODELS_CACHE_FAILURE_TTL
+            setattr(
+                app.state, state_key, {item["id"]: item for item in data["data"]}
+            )
+
+        return data
+    finally:
+        if cache["future"] is task:
+            cache["future"] = None
+
+
+async def warmup_models_and_assistants():
+    await asyncio.gather(get_all_models(), get_all_assistants())
+
+
+async def get_all_models(force=False):
+    return await get_cached(
+        app.state.MODELS_CACHE, fetch_all_models, "MODELS", force=force
+    )
+
+
+async def fetch_all_models():
+    log.info("fetch_all_models()")
+
+    complete = True
     if len(app.state.OPENAI_API_KEYS) == 1 and app.state.OPENAI_API_KEYS[0] == "":
         models = {"data": []}
     else:
@@ -232,6 +358,8 @@ async def get_all_models():
 
         responses = await asyncio.gather(*tasks)
         log.info(f"get_all_models:responses() {responses}")
+        # fetch_url returns None for an upstream that couldn't be reached
+        complete = None not in responses
 
         models = {
             "data": merge_models_lists(
@@ -249,9 +377,8 @@ async def get_all_models():
         }
 
         log.info(f"models: {models}")
-        app.state.MODELS = {model["id"]: model for model in models["data"]}
 
-        return models
+    return models, complete
 
 
 @app.get("/models")
@@ -261,13 +388,16 @@ async def get_models(url_idx: Optional[int] = None, user=Depends(get_current_use
         models = await get_all_models()
         if app.state.ENABLE_MODEL_FILTER:
             if user.role == "user":
-                models["data"] = list(
-                    filter(
-                        lambda model: model["id"] in app.state.MODEL_FILTER_LIST,
-                        models["data"],
-                    )
-                )
-                return models
+                # Copy so the cached model list is left untouched
+                return {
+                    **models,
+                    "data": list(
+                        filter(
+                            lambda model: model["id"] in app.state.MODEL_FILTER_LIST,
+                            models["data"],
+                        )
+                    ),
+                }
         return models
     else:
         url = app.state.OPENAI_API_BASE_URLS[url_idx]
@@ -275,10 +405,11 @@ async def get_models(url_idx: Optional[int] = None, user=Depends(get_current_use
         r = None
 
         try:
-            r = requests.request(method="GET", url=f"{url}/models")
-            r.raise_for_status()
+            session = await start_aiohttp_session()
+            r = await session.request(method="GET", url=f"{url}/models")
+            await check_response_status(r)
 
-            response_data = r.json()
+            response_data = await r.json(content_type=None)
             if "api.openai.com" in url:
                 response_data["data"] = list(
                     filter(lambda model: "gpt" in model["id"], response_data["data"])
@@ -290,21 +421,28 @@ async def get_models(url_idx: Optional[int] = None, user=Depends(get_current_use
             error_detail = "Open WebUI: Server Connection Error"
             if r is not None:
                 try:
-                    res = r.json()
+                    res = await r.json(content_type=None)
                     if "error" in res:
                         error_detail = f"External: {res['error']}"
                 except:
                     error_detail = f"External: {e}"
 
             raise HTTPException(
-                status_code=r.status_code if r else 500,
+                status_code=r.status if r else 500,
                 detail=error_detail,
             )
 
 async def get_all_assistants():
-    log.info("get_all_assistants()")
+    return await get_cached(
+        app.state.ASSISTANTS_CACHE, fetch_all_assistants, "ASSISTANTS"
+    )
+
+
+async def fetch_all_assistants():
+    log.info("fetch_all_assistants()")
 
     #TODO revert the check for the openai api key in state, so uncomment the line below and delete everything else
+    complete = True
     if len(app.state.OPENAI_API_KEYS) == 1 and app.state.OPENAI_API_KEYS[0] == "":
         assistants = {"data": []}
     else:
@@ -315,6 +453,8 @@ async def get_all_assistants():
 
         responses = await asyncio.gather(*tasks)
         log.info(f"get_all_assistants:responses() {responses}")
+        # fetch_url returns None for an upstream that couldn't be reached
+        complete = None not in responses
 
         assistants = {
             "data": merge_assistants_lists(
@@ -332,9 +472,8 @@ async def get_all_assistants():
         }
 
         log.info(f"assistants: {assistants}")
-        app.state.ASSISTANTS = {assistant["id"]: assistant for assistant in assistants["data"]}
 
-        return assistants
+    return assistants, complete
 
 @app.get("/assistants")
 @app.get("/assistants/{url_idx}")
@@ -348,10 +487,11 @@ async def get_assistants(url_idx: Optional[int] = None, user=Depends(get_current
         r = None
 
         try:
-            r = requests.request(method="GET", url=f"{url}/assistants")
-            r.raise_for_status()
+            session = await start_aiohttp_session()
+            r = await session.request(method="GET", url=f"{url}/assistants")
+            await check_response_status(r)
 
-            response_data = r.json()
+            response_data = await r.json(content_type=None)
 
             return response_data
         except Exception as e:
@@ -359,14 +499,14 @@ async def get_assistants(url_idx: Optional[int] = None, user=Depends(get_current
             error_detail = "Open WebUI: Server Connection Error"
             if r is not None:
                 try:
-                    res = r.json()
+                    res = await r.json(content_type=None)
                     if "error" in res:
                         error_detail = f"External: {res['error']}"
                 except:
                     error_detail = f"External: {e}"
 
             raise HTTPException(
-                status_code=r.status_code if r else 500,
+                status_code=r.status if r else 500,
                 detail=error_detail,
             )
 
@@ -377,14 +517,37 @@ async def proxy(path: str, request: Request, user=Depends(get_verified_user)):
 
     body = await request.body()
     log.info(f"proxy received: {path} {request.method} {body}")
+
+    # Only parse the body when it has to be rewritten or routed by model; with a
+    # single upstream the raw bytes can usually be forwarded as-is
+    if OPENAI_ASSISTANT_ID == "":
+        needs_rewrite = (
+            len(app.state.OPENAI_API_BASE_URLS) > 1
+            or b'"num_ctx"' in body
+            or b'"gpt-4-vision-preview"' in body
+        )
+    else:
+        needs_rewrite = b'"model"' in body or b'"max_tokens"' in body
+
     # TODO: Remove below after gpt-4-vision fix from Open AI
     # Try to decode the body of the request from bytes to a UTF-8 string (Require add max_token to fix gpt-4-vision)
-    if OPENAI_ASSISTANT_ID == "":
+    if not needs_rewrite:
+        pass
+    elif OPENAI_ASSISTANT_ID == "":
         try:
-            body = body.decode("utf-8")
-            body = json.loads(body)
-
-            idx = app.state.MODELS[body.get("model")]["urlIdx"]
+            body = orjson.loads(body)
+
+            # Models are warmed at startup; refetch if that hasn't finished or
+            # failed, or if the model was added upstream since the last fetch
+            model = body.get("model")
+            if model not in app.state.MODELS:
+                await get_all_models(force=True)
+            if model not in app.state.MODELS:
+                raise HTTPException(
+                    status_code=400,
+                    detail=ERROR_MESSAGES.MODEL_NOT_FOUND(model),
+                )
+            idx = app.state.MODELS[model]["urlIdx"]
 
             # Check if the model is "gpt-4-vision-preview" and set "max_tokens" to 4000
             # This is a workaround until OpenAI fixes the issue with this model
@@ -401,22 +564,21 @@ async def proxy(path: str, request: Request, user=Depends(get_verified_user)):
                 del body["num_ctx"]
 
             # Convert the modified body back to JSON
-            body = json.dumps(body)
-        except json.JSONDecodeError as e:
+            body = orjson.dumps(body)
+        except orjson.JSONDecodeError as e:
             log.error("Error loading request body into a dictionary:", e)
     
     else:
         try:
-            body = body.decode("utf-8")
-            body = json.loads(body)
+            body = orjson.loads(body)
             
             keys_to_delete = ["model", "max_tokens"]
             for key in keys_to_delete:
                 if key in body:
                     del body[key]
 
-            body = json.dumps(body)
-        except json.JSONDecodeError as e:
+            body = orjson.dumps(body)
+        except orjson.JSONDecodeError as e:
             log.error("Error loading request body into a dictionary:", e)
 
 
@@ -439,37 +601,54 @@ async def proxy(path: str, request: Request, user=Depends(get_verified_user)):
     r = None
 
     try:
-        r = requests.request(
+        session = await start_aiohttp_session()
+        r = await session.request(
             method=request.method,
             url=target_url,
             data=body,
             headers=headers,
-            stream=True,
+            timeout=aiohttp.ClientTimeout(total=None),
         )
 
-        r.raise_for_status()
+        await check_response_status(r)
 
         # Check if response is SSE
         if "text/event-stream" in r.headers.get("Content-Type", ""):
+            # Forward chunks as they arrive, releasing the upstream connection on
+            # the event loop once the stream ends or the client disconnects
+            async def stream_content():
+                try:
+                    async for chunk in r.content.iter_any():
+                        yield chunk
+                finally:
+                    r.release()
+
+            # aiohttp has already decoded the body, so the upstream
+            # encoding/length headers no longer apply
             return StreamingResponse(
-                r.iter_content(chunk_size=8192),
-                status_code=r.status_code,
-                headers=dict(r.headers),
+                stream_content(),
+                status_code=r.status,
+                headers={
+                    k: v
+                    for k, v in r.headers.items()
+                    if k.lower()
+                    not in ("content-encoding", "transfer-encoding", "content-length")
+                },
             )
         else:
-            response_data = r.json()
+            response_data = await r.json(content_type=None)
             return response_data
     except Exception as e:
         log.exception(e)
         error_detail = "Open WebUI: Server Connection Error"
         if r is not None:
             try:
-                res = r.json()
+                res = await r.json(content_type=None)
                 if "error" in res:
                     error_detail = f"External: {res['error']['message'] if 'message' in res['error'] else res['error']}"
             except:
                 error_detail = f"External: {e}"
 
         raise HTTPException(
-            status_code=r.status_code if r else 500, detail=error_detail
+            status_code=r.status if r else 500, detail=error_detail
         )
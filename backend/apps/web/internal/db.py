@@ -21,3 +21,9 @@ log.info(f"Connected to a {DB.__class__.__name__} database.")
 router = Router(DB, migrate_dir="apps/web/internal/migrations", logger=log)
 router.run()
 DB.connect(reuse_if_open=True)
+
+# UPDATE ... RETURNING is supported by Postgres and SQLite 3.35+, not MySQL.
+# server_version reflects the driver peewee actually loaded (e.g. pysqlite3).
+DB_SUPPORTS_RETURNING = isinstance(DB, PostgresqlDatabase) or (
+    isinstance(DB, SqliteDatabase) and DB.server_version >= (3, 35, 0)
+)
@@ -1,6 +1,7 @@
 from fastapi import FastAPI, Depends
 from fastapi.routing import APIRoute
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from apps.web.routers import (
     auths,
     users,
@@ -23,7 +24,7 @@ from config import (
     WEBUI_AUTH_TRUSTED_EMAIL_HEADER,
 )
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 origins = ["*"]
 
@@ -3,16 +3,17 @@ from typing import List, Union, Optional
 from peewee import *
 from playhouse.shortcuts import model_to_dict
 
-import json
+import orjson
 import uuid
 import time
 
-from apps.web.internal.db import DB
+from apps.web.internal.db import DB, DB_SUPPORTS_RETURNING
 
 ####################
 # Thread DB Schema
 ####################
 
+
 class Thread(Model):
     id = CharField(unique=True)
     user_id = CharField()
@@ -20,6 +21,7 @@ class Thread(Model):
 
     class Meta:
         database = DB
+        indexes = ((("user_id",), False),)
 
 
 ####################
@@ -42,6 +44,8 @@ class Chat(Model):
 
     class Meta:
         database = DB
+        # Chat lists filter on (user_id, archived) and sort by updated_at
+        indexes = ((("user_id", "archived", "updated_at"), False),)
 
 
 class ChatModel(BaseModel):
@@ -57,6 +61,7 @@ class ChatModel(BaseModel):
     share_id: Optional[str] = None
     archived: bool = False
 
+
 class ThreadModel(BaseModel):
     id: str
     user_id: str
@@ -90,10 +95,12 @@ class ChatResponse(BaseModel):
 
 class ChatTitleIdResponse(BaseModel):
     id: str
+    thread_id: Optional[str] = None
     title: str
     updated_at: int
     created_at: int
 
+
 class ThreadTable:
     def __init__(self, db):
         self.db = db
@@ -125,40 +132,69 @@ class ChatTable:
         self.db = db
         db.create_tables([Chat, Thread])
 
-    def insert_new_chat(self, user_id: str, form_data: ChatForm, thread_id: Optional[str] = None) -> Optional[ChatModel]:
+        self.update_returning = DB_SUPPORTS_RETURNING
+
+        # The sidebar list is polled constantly, so its SQL is rendered once here
+        # (with the database's own placeholders) and re-executed with new params,
+        # skipping peewee's query compiler and letting the driver cache the plan
+        self.chat_titles_fields = [
+            "id",
+            "thread_id",
+            "title",
+            "updated_at",
+            "created_at",
+        ]
+        # NOTE: _get_chat_titles binds its params positionally as
+        # (archived, user_id), matching the order of the .where() calls below;
+        # keep the two in sync if this query changes
+        self.chat_titles_sql, _ = (
+            Chat.select(*[getattr(Chat, name) for name in self.chat_titles_fields])
+            .where(Chat.archived == False)
+            .where(Chat.user_id == "")
+            .order_by(Chat.updated_at.desc())
+            .sql()
+        )
+
+    def _update_and_get_chat(self, query, id: str) -> Optional[ChatModel]:
+        if self.update_returning:
+            # Read the updated row back in the same round trip
+            rows = list(query.returning(Chat).dicts().execute())
+            return ChatModel.model_construct(**rows[0]) if rows else None
+
+        query.execute()
+
+        chat = Chat.get(Chat.id == id)
+        return ChatModel(**model_to_dict(chat))
+
+    def insert_new_chat(
+        self, user_id: str, form_data: ChatForm, thread_id: Optional[str] = None
+    ) -> Optional[ChatModel]:
         id = str(uuid.uuid4())
+        now = int(time.time())
         chat_data = {
             "id": id,
             "user_id": user_id,
             "title": form_data.chat.get("title", "New Chat"),
-            "chat": json.dumps(form_data.chat),
-            "created_at": int(time.time()),
-            "updated_at": int(time.time()),
-            "thread_id": thread_id  # Add the thread_id to the chat data
+            "chat": orjson.dumps(form_data.chat).decode("utf-8"),
+            "created_at": now,
+            "updated_at": now,
+            "thread_id": thread_id,  # Add the thread_id to the chat data
         }
-        chat = ChatModel(**chat_data)
-        result = Chat.create(**chat.dict(exclude_unset=True))
-        return chat if result else None
+        result = Chat.create(**chat_data)
+        return ChatModel.model_construct(**chat_data) if result else None
 
     def update_chat_by_id(self, id: str, chat: dict) -> Optional[ChatModel]:
         try:
+            values = {
+                "chat": orjson.dumps(chat).decode("utf-8"),
+                "title": chat["title"] if "title" in chat else "New Chat",
+                "updated_at": int(time.time()),
+            }
             if "thread_id" in chat:
-                query = Chat.update(
-                chat=json.dumps(chat),
-                title=chat["title"] if "title" in chat else "New Chat",
-                thread_id=chat["thread_id"],
-                updated_at=int(time.time()),
-            ).where(Chat.id == id)
-            else:
-                query = Chat.update(
-                    chat=json.dumps(chat),
-                    title=chat["title"] if "title" in chat else "New Chat",
-                    updated_at=int(time.time()),
-                ).where(Chat.id == id)
-            query.execute()
+                values["thread_id"] = chat["thread_id"]
 
-            chat = Chat.get(Chat.id == id)
-            return ChatModel(**model_to_dict(chat))
+            query = Chat.update(**values).where(Chat.id == id)
+            return self._update_and_get_chat(query, id)
         except:
             return None
 
@@ -169,24 +205,28 @@ class ChatTable:
         if chat.share_id:
             return self.get_chat_by_id_and_user_id(chat.share_id, "shared")
         # Create a new chat with the same data, but with a new ID
-        shared_chat = ChatModel(
-            **{
-                "id": str(uuid.uuid4()),
-                "user_id": f"shared-{chat_id}",
-                "thread_id": chat.thread_id,
-                "title": chat.title,
-                "chat": chat.chat,
-                "created_at": chat.created_at,
-                "updated_at": int(time.time()),
-            }
-        )#possible that **shared_chat.model_dump() is needed
-        shared_result = Chat.create(**shared_chat.dict())
+        shared_chat_data = {
+            "id": str(uuid.uuid4()),
+            "user_id": f"shared-{chat_id}",
+            "thread_id": chat.thread_id,
+            "title": chat.title,
+            "chat": chat.chat,
+            "created_at": chat.created_at,
+            "updated_at": int(time.time()),
+        }
+        shared_result = Chat.create(**shared_chat_data)
         # Update the original chat with the share_id
         result = (
-            Chat.update(share_id=shared_chat.id).where(Chat.id == chat_id).execute()
+            Chat.update(share_id=shared_chat_data["id"])
+            .where(Chat.id == chat_id)
+            .execute()
         )
 
-        return shared_chat if (shared_result and result) else None
+        return (
+            ChatModel.model_construct(**shared_chat_data)
+            if (shared_result and result)
+            else None
+        )
 
     def update_shared_chat_by_chat_id(self, chat_id: str) -> Optional[ChatModel]:
         try:
@@ -199,10 +239,7 @@ class ChatTable:
                 chat=chat.chat,
             ).where(Chat.id == chat.share_id)
 
-            query.execute()
-
-            chat = Chat.get(Chat.id == chat.share_id)
-            return ChatModel(**model_to_dict(chat))
+            return self._update_and_get_chat(query, chat.share_id)
         except:
             return None
 
@@ -222,62 +259,54 @@ class ChatTable:
             query = Chat.update(
                 share_id=share_id,
             ).where(Chat.id == id)
-            query.execute()
 
-            chat = Chat.get(Chat.id == id)
-            return ChatModel(**model_to_dict(chat))
+            return self._update_and_get_chat(query, id)
         except:
             return None
 
     def toggle_chat_archive_by_id(self, id: str) -> Optional[ChatModel]:
         try:
-            chat = self.get_chat_by_id(id)
             query = Chat.update(
-                archived=(not chat.archived),
+                archived=~Chat.archived,
             ).where(Chat.id == id)
 
-            query.execute()
-
-            chat = Chat.get(Chat.id == id)
-            return ChatModel(**model_to_dict(chat))
+            return self._update_and_get_chat(query, id)
         except:
             return None
 
-    def get_archived_chat_list_by_user_id(
-        self, user_id: str, skip: int = 0, limit: int = 50
-    ) -> List[ChatModel]:
+    def _get_chat_titles(
+        self, user_id: str, archived: bool
+    ) -> List[ChatTitleIdResponse]:
+        # Params are bound in the order of the .where() calls that built
+        # chat_titles_sql in __init__: archived first, then user_id
+        cursor = self.db.execute_sql(self.chat_titles_sql, (archived, user_id))
         return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select()
-            .where(Chat.archived == True)
-            .where(Chat.user_id == user_id)
-            .order_by(Chat.updated_at.desc())
-            # .limit(limit)
-            # .offset(skip)
+            ChatTitleIdResponse.model_construct(
+                **dict(zip(self.chat_titles_fields, row))
+            )
+            for row in cursor.fetchall()
         ]
 
-    def get_chat_list_by_user_id(
+    def get_chat_titles_by_user_id(
         self, user_id: str, skip: int = 0, limit: int = 50
-    ) -> List[ChatModel]:
-        return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select()
-            .where(Chat.archived == False)
-            .where(Chat.user_id == user_id)
-            .order_by(Chat.updated_at.desc())
-            # .limit(limit)
-            # .offset(skip)
-        ]
+    ) -> List[ChatTitleIdResponse]:
+        return self._get_chat_titles(user_id, False)
+
+    def get_archived_chat_titles_by_user_id(
+        self, user_id: str, skip: int = 0, limit: int = 50
+    ) -> List[ChatTitleIdResponse]:
+        return self._get_chat_titles(user_id, True)
 
     def get_chat_list_by_chat_ids(
         self, chat_ids: List[str], skip: int = 0, limit: int = 50
     ) -> List[ChatModel]:
         return [
-            ChatModel(**model_to_dict(chat))
+            ChatModel.model_construct(**chat)
             for chat in Chat.select()
             .where(Chat.archived == False)
             .where(Chat.id.in_(chat_ids))
             .order_by(Chat.updated_at.desc())
+            .dicts()
         ]
 
     def get_chat_by_id(self, id: str) -> Optional[ChatModel]:
@@ -308,58 +337,74 @@ class ChatTable:
 
     def get_chats(self, skip: int = 0, limit: int = 50) -> List[ChatModel]:
         return [
-            ChatModel(**model_to_dict(chat))
-            for chat in Chat.select().order_by(Chat.updated_at.desc())
+            ChatModel.model_construct(**chat)
+            for chat in Chat.select().order_by(Chat.updated_at.desc()).dicts()
             # .limit(limit).offset(skip)
         ]
 
     def get_chats_by_user_id(self, user_id: str) -> List[ChatModel]:
         return [
-            ChatModel(**model_to_dict(chat))
+            ChatModel.model_construct(**chat)
             for chat in Chat.select()
             .where(Chat.user_id == user_id)
             .order_by(Chat.updated_at.desc())
+            .dicts()
             # .limit(limit).offset(skip)
         ]
 
+    def _chat_ids_with_shared_copies(self, where):
+        # Ids of the chats matching `where` plus their shared copies, which are
+        # referenced by share_id. Both sides of the union read an aliased Chat so
+        # they aren't correlated with the outer DELETE, and the derived table
+        # lets MySQL delete from the table the subquery reads
+        source = Chat.alias("source")
+        chat_ids = source.select(source.id).where(where(source))
+        shared_ids = source.select(source.share_id).where(
+            where(source) & source.share_id.is_null(False)
+        )
+        targets = (chat_ids | shared_ids).alias("targets")
+        return Select([targets], [targets.c.id])
+
     def delete_chat_by_id(self, id: str) -> bool:
         try:
-            query = Chat.delete().where((Chat.id == id))
+            # Remove the chat and its shared copy, if any, in a single query
+            query = Chat.delete().where(
+                Chat.id.in_(
+                    self._chat_ids_with_shared_copies(lambda chat: chat.id == id)
+                )
+            )
             query.execute()  # Remove the rows, return number of rows removed.
 
-            return True and self.delete_shared_chat_by_chat_id(id)
+            return True
         except:
             return False
 
     def delete_chat_by_id_and_user_id(self, id: str, user_id: str) -> bool:
         try:
-            query = Chat.delete().where((Chat.id == id) & (Chat.user_id == user_id))
-            query.execute()  # Remove the rows, return number of rows removed.
-
-            return True and self.delete_shared_chat_by_chat_id(id)
-        except:
-            return False
-
-    def delete_chats_by_user_id(self, user_id: str) -> bool:
-        try:
-
-            self.delete_shared_chats_by_user_id(user_id)
-
-            query = Chat.delete().where(Chat.user_id == user_id)
+            # Remove the chat and its shared copy, if any, in a single query
+            query = Chat.delete().where(
+                Chat.id.in_(
+                    self._chat_ids_with_shared_copies(
+                        lambda chat: (chat.id == id) & (chat.user_id == user_id)
+                    )
+                )
+            )
             query.execute()  # Remove the rows, return number of rows removed.
 
             return True
         except:
             return False
 
-    def delete_shared_chats_by_user_id(self, user_id: str) -> bool:
+    def delete_chats_by_user_id(self, user_id: str) -> bool:
         try:
-            shared_chat_ids = [
-                f"shared-{chat.id}"
-                for chat in Chat.select().where(Chat.user_id == user_id)
-            ]
-
-            query = Chat.delete().where(Chat.user_id << shared_chat_ids)
+            # Remove the user's chats and their shared copies in a single query
+            query = Chat.delete().where(
+                Chat.id.in_(
+                    self._chat_ids_with_shared_copies(
+                        lambda chat: chat.user_id == user_id
+                    )
+                )
+            )
             query.execute()  # Remove the rows, return number of rows removed.
 
             return True
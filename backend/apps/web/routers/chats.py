@@ -45,7 +45,7 @@ router = APIRouter()
 async def get_session_user_chat_list(
     user=Depends(get_current_user), skip: int = 0, limit: int = 50
 ):
-    return Chats.get_chat_list_by_user_id(user.id, skip, limit)
+    return Chats.get_chat_titles_by_user_id(user.id, skip, limit)
 
 
 ############################
@@ -78,7 +78,7 @@ async def delete_all_user_chats(request: Request, user=Depends(get_current_user)
 async def get_user_chat_list_by_user_id(
     user_id: str, user=Depends(get_admin_user), skip: int = 0, limit: int = 50
 ):
-    return Chats.get_chat_list_by_user_id(user_id, skip, limit)
+    return Chats.get_chat_titles_by_user_id(user_id, skip, limit)
 
 
 ############################
@@ -90,7 +90,7 @@ async def get_user_chat_list_by_user_id(
 async def get_archived_session_user_chat_list(
     user=Depends(get_current_user), skip: int = 0, limit: int = 50
 ):
-    return Chats.get_archived_chat_list_by_user_id(user.id, skip, limit)
+    return Chats.get_archived_chat_titles_by_user_id(user.id, skip, limit)
 
 
 ############################
@@ -14,6 +14,7 @@ from fastapi.staticfiles import StaticFiles
 from fastapi import HTTPException
 from fastapi.middleware.wsgi import WSGIMiddleware
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import StreamingResponse, Response
@@ -21,7 +22,11 @@ from starlette.types import Message, Receive, Scope, Send
 from starlette.datastructures import Headers, URL
 
 from apps.ollama.main import app as ollama_app
-from apps.openai.main import app as openai_app
+from apps.openai.main import (
+    app as openai_app,
+    startup_event as openai_startup_event,
+    shutdown_event as openai_shutdown_event,
+)
 
 from apps.litellm.main import (
     app as litellm_app,
@@ -95,7 +100,11 @@ https://github.com/open-webui/open-webui
 """
 )
 
-app = FastAPI(docs_url="/docs" if ENV == "dev" else None, redoc_url=None)
+app = FastAPI(
+    docs_url="/docs" if ENV == "dev" else None,
+    redoc_url=None,
+    default_response_class=ORJSONResponse,
+)
 
 app.state.ENABLE_MODEL_FILTER = ENABLE_MODEL_FILTER
 app.state.MODEL_FILTER_LIST = MODEL_FILTER_LIST
@@ -303,6 +312,8 @@ async def on_startup():
     if ENABLE_LITELLM:
         asyncio.create_task(start_litellm_background())
 
+    await openai_startup_event()
+
 
 app.mount("/api/v1", webui_app)
 app.mount("/litellm/api", litellm_app)
@@ -475,3 +486,5 @@ else:
 async def shutdown_event():
     if ENABLE_LITELLM:
         await shutdown_litellm_background()
+
+    await openai_shutdown_event()